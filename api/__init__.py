@@ -0,0 +1,3 @@
+"""
+后端 API 包
+"""
@@ -2,68 +2,277 @@
 共享的工具函数和配置
 """
 
-import math
+import asyncio
+import copy
+import hashlib
+import random
+import threading
 import datetime as dt
-from typing import Tuple
+from typing import AsyncIterator, Iterator, Tuple
 
 import httpx
+from cachetools import LRUCache, TTLCache
 from fastapi import HTTPException
+from starlette.concurrency import iterate_in_threadpool
 from supabase import create_client, Client
 from zai import ZhipuAiClient
 
 # 从 config 模块导入配置
-from api.config import SUPABASE_URL, SUPABASE_SERVICE_KEY, ZHIPU_API_KEY
+from api.config import SUPABASE_URL, SUPABASE_SERVICE_KEY, ZHIPU_API_KEY, ZHIPU_MAX_CONCURRENCY
+
+
+# 进程内复用的智谱客户端，复用其底层 HTTP 连接池
+_ZHIPU_CLIENT: ZhipuAiClient | None = None
+_ZHIPU_CLIENT_LOCK = threading.Lock()
 
 
 def get_zhipu_client() -> ZhipuAiClient:
-    """创建 ZhipuAiClient。"""
-    return ZhipuAiClient(api_key=ZHIPU_API_KEY)
+    """获取进程级单例的 ZhipuAiClient（翻译在线程池中执行，需加锁初始化）。"""
+    global _ZHIPU_CLIENT
+    if _ZHIPU_CLIENT is None:
+        with _ZHIPU_CLIENT_LOCK:
+            if _ZHIPU_CLIENT is None:
+                # 关闭 SDK 内置重试，由 translate_text_sync 统一重试（遵循 Retry-After）
+                _ZHIPU_CLIENT = ZhipuAiClient(api_key=ZHIPU_API_KEY, max_retries=0)
+    return _ZHIPU_CLIENT
+
+
+# 翻译系统提示词模板，仅目标语言需要按请求替换
+_SYS_PROMPT_TMPL = (
+    "你是一个专业的翻译助手。"
+    "请将我给你的文本翻译成目标语言：{lang}。"
+    "目标语言的描述可能是自然语言（例如'简体中文''英语'），"
+    "也可能是语言代码（例如 zh、en、ja、fr 等），"
+    "请根据这个描述自行理解目标语言并进行翻译。"
+    "只输出翻译后的文本本身，不要任何解释或前后缀。"
+)
+
+# 常用目标语言的提示词在启动时生成，请求时只需查表
+_SYS_PROMPTS = {
+    lang: _SYS_PROMPT_TMPL.format(lang=lang)
+    for lang in ("英文", "中文", "简体中文", "日文", "韩文", "en", "zh", "ja", "ko")
+}
+
+
+def _system_prompt(target_lang: str) -> str:
+    prompt = _SYS_PROMPTS.get(target_lang)
+    return prompt if prompt is not None else _SYS_PROMPT_TMPL.format(lang=target_lang)
+
+
+def _chat_params(text: str, target_lang: str) -> dict:
+    """翻译请求的公共参数（不含 stream）。"""
+    return {
+        "model": "GLM-4-Flash-250414",
+        "messages": [
+            {
+                "role": "system",
+                "content": _system_prompt(target_lang),
+            },
+            {
+                "role": "user",
+                "content": text,
+            },
+        ],
+        "thinking": {"type": "disabled"},
+        "max_tokens": 2048,
+        "temperature": 0.3,
+    }
+
+
+# 翻译结果缓存，key 为 (原文, 目标语言)；只缓存成功的结果
+# 按字符数限制容量（原文 + 译文都计入），过长的原文不缓存
+_TRANSLATION_CACHE_MAX_CHARS = 2_000_000
+_TRANSLATION_CACHE_MAX_TEXT = 2000
+_TRANSLATION_CACHE: LRUCache = LRUCache(
+    maxsize=_TRANSLATION_CACHE_MAX_CHARS,
+    getsizeof=lambda entry: entry[1],
+)
+_TRANSLATION_CACHE_LOCK = threading.Lock()
 
 
-def translate_text_sync(text: str, target_lang: str) -> Tuple[bool, str, float]:
+def _get_cached_translation(text: str, target_lang: str) -> str | None:
+    with _TRANSLATION_CACHE_LOCK:
+        entry = _TRANSLATION_CACHE.get((text, target_lang))
+    return entry[0] if entry is not None else None
+
+
+def _cache_translation(text: str, target_lang: str, result: str) -> None:
+    if not result or len(text) + len(target_lang) > _TRANSLATION_CACHE_MAX_TEXT:
+        return
+    size = len(text) + len(target_lang) + len(result)
+    if size > _TRANSLATION_CACHE_MAX_CHARS:
+        return
+    with _TRANSLATION_CACHE_LOCK:
+        _TRANSLATION_CACHE[(text, target_lang)] = (result, size)
+
+
+# 智谱调用的最大尝试次数（仅对限流 429 和 5xx 重试）
+_ZHIPU_MAX_ATTEMPTS = 3
+
+
+def _retry_delay(error: Exception, attempt: int) -> float | None:
     """
-    同步版本的翻译函数。
+    根据异常判断是否需要重试，返回等待秒数；不可重试时返回 None。
+    优先遵循响应中的 Retry-After，否则指数退避并加抖动。
+    """
+    response = getattr(error, "response", None)
+    status_code = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status_code != 429 and not (isinstance(status_code, int) and status_code >= 500):
+        return None
+
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return min(float(retry_after), 10.0)
+        except ValueError:
+            pass
+    return (2 ** attempt) * 0.5 + random.random() * 0.2
+
+
+def translate_text_sync(
+    text: str, target_lang: str, client: ZhipuAiClient | None = None
+) -> Tuple[bool, str, float]:
+    """
+    同步版本的翻译函数。相同的 (原文, 目标语言) 直接返回缓存结果。
+    client 默认使用进程级单例，批量/并发调用方也可自行传入共享的客户端。
     返回: (是否成功, 错误信息或结果, 耗时)
     """
     import time
     start_time = time.time()
-    try:
-        client = get_zhipu_client()
-        response = client.chat.completions.create(
-            model="GLM-4-Flash-250414",
-            messages=[
-                {
-                    "role": "user",
-                    "content": (
-                        "你是一个专业的翻译助手。"
-                        f"请将我给你的文本翻译成目标语言：{target_lang}。"
-                        "目标语言的描述可能是自然语言（例如'简体中文''英语'），"
-                        "也可能是语言代码（例如 zh、en、ja、fr 等），"
-                        "请根据这个描述自行理解目标语言并进行翻译。"
-                        "只输出翻译后的文本本身，不要任何解释或前后缀。"
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": text,
-                },
-            ],
-            thinking={"type": "disabled"},
-            stream=False,
-            max_tokens=2048,
-            temperature=0.3,
+    cached = _get_cached_translation(text, target_lang)
+    if cached is not None:
+        return True, cached, time.time() - start_time
+
+    for attempt in range(_ZHIPU_MAX_ATTEMPTS):
+        try:
+            client = client or get_zhipu_client()
+            response = client.chat.completions.create(
+                **_chat_params(text, target_lang),
+                stream=False,
+            )
+
+            result = response.choices[0].message.content
+            _cache_translation(text, target_lang, result)
+            elapsed = time.time() - start_time
+            return True, result, elapsed
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == _ZHIPU_MAX_ATTEMPTS - 1:
+                elapsed = time.time() - start_time
+                return False, str(e), elapsed
+            # 在线程池中执行，sleep 不会阻塞事件循环
+            time.sleep(delay)
+
+
+# 进程内限制同时发往智谱的请求数
+_ZHIPU_SEM = asyncio.Semaphore(ZHIPU_MAX_CONCURRENCY)
+
+
+async def translate_text_async(text: str, target_lang: str) -> Tuple[bool, str, float]:
+    """
+    异步版本的翻译函数：在线程池中执行同步 SDK 调用，避免阻塞事件循环。
+    命中缓存时直接返回，否则在并发上限内排队调用智谱。
+    返回: (是否成功, 错误信息或结果, 耗时)
+    """
+    cached = _get_cached_translation(text, target_lang)
+    if cached is not None:
+        return True, cached, 0.0
+
+    _ensure_loop_bound()
+    async with _ZHIPU_SEM:
+        return await asyncio.to_thread(translate_text_sync, text, target_lang)
+
+
+def translate_text_stream_sync(
+    text: str, target_lang: str, client: ZhipuAiClient | None = None
+) -> Iterator[str]:
+    """
+    同步版本的流式翻译：逐段产出译文，完整结束后写入翻译缓存。
+    建立流时与 translate_text_sync 相同地重试 429/5xx；开始产出后出错直接抛出异常。
+    """
+    import time
+    client = client or get_zhipu_client()
+    for attempt in range(_ZHIPU_MAX_ATTEMPTS):
+        try:
+            response = client.chat.completions.create(
+                **_chat_params(text, target_lang),
+                stream=True,
+            )
+            break
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == _ZHIPU_MAX_ATTEMPTS - 1:
+                raise
+            # 在线程池中执行，sleep 不会阻塞事件循环
+            time.sleep(delay)
+
+    parts = []
+    for chunk in response:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    _cache_translation(text, target_lang, "".join(parts))
+
+
+async def translate_text_stream(text: str, target_lang: str) -> AsyncIterator[str]:
+    """
+    异步版本的流式翻译：在线程池中迭代 SDK 的流式响应，并受并发上限约束。
+    命中缓存时一次性产出完整译文。
+    """
+    cached = _get_cached_translation(text, target_lang)
+    if cached is not None:
+        yield cached
+        return
+
+    _ensure_loop_bound()
+    async with _ZHIPU_SEM:
+        async for delta in iterate_in_threadpool(translate_text_stream_sync(text, target_lang)):
+            yield delta
+
+
+# 共享的异步 HTTP 客户端，保持到 Supabase 的 HTTP/2 长连接（并发请求复用同一连接）
+_HTTP: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的 HTTP 客户端；未经 startup 初始化时（如 serverless 环境）按需创建。"""
+    global _HTTP
+    _ensure_loop_bound()
+    if _HTTP is None or _HTTP.is_closed:
+        _HTTP = httpx.AsyncClient(
+            base_url=SUPABASE_URL,
+            timeout=10,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=30,
+            ),
         )
+    return _HTTP
+
+
+async def close_http_client() -> None:
+    """关闭共享的 HTTP 客户端（应用关闭时调用）。"""
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
+
 
-        result = response.choices[0].message.content
-        elapsed = time.time() - start_time
-        return True, result, elapsed
-    except Exception as e:
-        elapsed = time.time() - start_time
-        return False, str(e), elapsed
+# 进程内复用的 Supabase 客户端，避免每个请求重新构建
+_SB_CLIENT: Client | None = None
 
 
 def get_supabase_client() -> Client:
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    """获取进程级单例的 Supabase 客户端。"""
+    global _SB_CLIENT
+    if _SB_CLIENT is None:
+        _SB_CLIENT = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    return _SB_CLIENT
 
 
 class AuthedUser:
@@ -76,83 +285,145 @@ class AuthedUser:
         self.billing_period_start = billing_period_start
 
 
-async def get_current_user(authorization: str = None) -> AuthedUser:
+# 已解析用户的短期缓存，key 为 access token 的哈希（不保存原始 token）
+_USER_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_USER_CACHE_LOCK = asyncio.Lock()
+# 正在校验中的 token，避免同一用户的并发请求重复校验
+_USER_INFLIGHT: dict[bytes, asyncio.Task] = {}
+
+# 上述与事件循环绑定的对象（连接池、锁、信号量、进行中的任务）所属的循环
+_BOUND_LOOP: asyncio.AbstractEventLoop | None = None
+
+
+def _ensure_loop_bound() -> None:
     """
-    从 Authorization: Bearer <jwt> 中解析 Supabase 用户，
-    并在 public.users 中找到对应行（没有则创建）。
+    如果运行时为不同调用使用了新的事件循环（如部分 serverless ASGI 适配器），
+    旧循环上的连接池、锁和信号量都不可再用，这里在新循环上整体重建。
     """
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="缺少 Authorization Bearer token")
+    global _BOUND_LOOP, _HTTP, _USER_CACHE_LOCK, _ZHIPU_SEM, _USER_INFLIGHT
+    loop = asyncio.get_running_loop()
+    if loop is _BOUND_LOOP:
+        return
+    _BOUND_LOOP = loop
+    # 旧连接池的连接属于已失效的循环，无法 aclose，直接丢弃
+    _HTTP = None
+    _USER_CACHE_LOCK = asyncio.Lock()
+    _ZHIPU_SEM = asyncio.Semaphore(ZHIPU_MAX_CONCURRENCY)
+    _USER_INFLIGHT = {}
+
 
+def _token_cache_key(authorization: str) -> bytes:
     access_token = authorization.split(" ", 1)[1]
+    return hashlib.blake2b(access_token.encode(), digest_size=16).digest()
+
+
+async def cache_current_user(authorization: str, user: AuthedUser) -> None:
+    """用最新的用户状态（如翻译后的用量）刷新缓存。"""
+    key = _token_cache_key(authorization)
+    _ensure_loop_bound()
+    async with _USER_CACHE_LOCK:
+        _USER_CACHE[key] = copy.copy(user)
+
+
+async def invalidate_current_user(authorization: str) -> None:
+    """丢弃缓存的用户状态，下次请求重新从数据库读取（如额度被数据库拒绝时）。"""
+    key = _token_cache_key(authorization)
+    _ensure_loop_bound()
+    async with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(key, None)
+
+
+async def _resolve_user(access_token: str, today: dt.date) -> AuthedUser:
+    """调用 Supabase Auth 校验 token，并在 public.users 中找到对应行（没有则创建）。"""
     sb = get_supabase_client()
 
     # 调用 Supabase Auth API 获取用户信息
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_URL}/auth/v1/user",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "apikey": SUPABASE_SERVICE_KEY,
-            },
-            timeout=10,
-        )
+    resp = await get_http_client().get(
+        "/auth/v1/user",
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "apikey": SUPABASE_SERVICE_KEY,
+        },
+    )
     if resp.status_code != 200:
         raise HTTPException(status_code=401, detail="无效的 Supabase 会话")
 
     auth_user = resp.json()
     auth_user_id = auth_user["id"]  # uuid
 
-    # 映射到 public.users（如果不存在则自动创建）
-    data = (
-        sb.table("users")
-        .select("*")
-        .eq("auth_user_id", auth_user_id)
-        .execute()
-    ).data
-
-    if data:
-        row = data[0]
-    else:
-        profile = {
-            "auth_user_id": auth_user_id,
-            "name": auth_user.get("user_metadata", {}).get("full_name") or auth_user.get("email"),
-        }
-        row = sb.table("users").insert(profile).execute().data[0]
-
-    return AuthedUser(
+    # 映射到 public.users（如果不存在则自动创建），只取用到的列
+    # supabase 同步客户端会阻塞，放到线程中执行
+    rpc = sb.rpc(
+        "get_or_create_user",
+        {
+            "p_auth_user_id": auth_user_id,
+            "p_name": auth_user.get("user_metadata", {}).get("full_name") or auth_user.get("email"),
+        },
+    )
+    row = (await asyncio.to_thread(rpc.execute)).data[0]
+
+    user = AuthedUser(
         auth_user_id=auth_user_id,
         user_row_id=row["id"],
         monthly_quota_tokens=row.get("monthly_quota_tokens", 50000),
         used_tokens_this_period=row.get("used_tokens_this_period", 0),
         billing_period_start=dt.date.fromisoformat(row.get("billing_period_start")),
     )
+    return refresh_billing_period(user, today)
+
+
+async def get_current_user(authorization: str = None) -> AuthedUser:
+    """
+    从 Authorization: Bearer <jwt> 中解析 Supabase 用户，
+    并在 public.users 中找到对应行（没有则创建）。
+    同一 token 的并发请求只会触发一次校验。
+    """
+    if not authorization or not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="缺少 Authorization Bearer token")
+
+    key = _token_cache_key(authorization)
+    today = dt.date.today()
+    _ensure_loop_bound()
+    async with _USER_CACHE_LOCK:
+        cached = _USER_CACHE.get(key)
+        if cached is not None:
+            if _month_index(cached.billing_period_start) == _month_index(today):
+                # 返回副本，避免调用方的修改污染缓存
+                return copy.copy(cached)
+            del _USER_CACHE[key]
+
+        task = _USER_INFLIGHT.get(key)
+        if task is None:
+            access_token = authorization.split(" ", 1)[1]
+            task = asyncio.ensure_future(_resolve_user(access_token, today))
+            _USER_INFLIGHT[key] = task
+            task.add_done_callback(lambda _t: _USER_INFLIGHT.pop(key, None))
+
+    # shield：单个请求被取消时不影响其他等待同一结果的请求
+    user = await asyncio.shield(task)
+    async with _USER_CACHE_LOCK:
+        _USER_CACHE[key] = user
+    return copy.copy(user)
 
 
 def estimate_tokens(text: str) -> int:
-    """简单估算 token 数：按字符数 / 1.5 向上取整。"""
-    chars = len(text)
-    return max(1, math.ceil(chars / 1.5))
+    """简单估算 token 数：按字符数 / 1.5 向上取整（整数运算：ceil(2n/3)）。"""
+    n = len(text)
+    return (2 * n + 2) // 3 if n else 1
 
 
-def refresh_billing_period(sb: Client, user: AuthedUser) -> AuthedUser:
-    """如果已经跨月，则重置本期用量。"""
-    today = dt.date.today()
-    if (today.year, today.month) != (user.billing_period_start.year, user.billing_period_start.month):
-        res = (
-            sb.table("users")
-            .update(
-                {
-                    "used_tokens_this_period": 0,
-                    "billing_period_start": today.isoformat(),
-                }
-            )
-            .eq("id", user.user_row_id)
-            .execute()
-        )
-        row = res.data[0]
+def _month_index(day: dt.date) -> int:
+    """把日期映射为连续的月份序号，跨月判断只需一次整数比较。"""
+    return day.year * 12 + day.month - 1
+
+
+def refresh_billing_period(user: AuthedUser, today: dt.date | None = None) -> AuthedUser:
+    """
+    如果已经跨月，则按新账期看待本期用量。
+    数据库中的重置由 try_reserve_tokens 在预占额度时原子完成，这里不再单独写库。
+    """
+    today = today or dt.date.today()
+    if _month_index(today) != _month_index(user.billing_period_start):
         user.used_tokens_this_period = 0
         user.billing_period_start = today
-        user.monthly_quota_tokens = row.get("monthly_quota_tokens", user.monthly_quota_tokens)
     return user
-
@@ -2,19 +2,41 @@
 FastAPI 应用主文件 - 统一的 FastAPI app 实例
 """
 
+import os
+import sys
+
+# 以脚本方式启动（python api/app.py）时项目根目录不在 sys.path 中，统一在入口处补上一次
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT_DIR not in sys.path:
+    sys.path.insert(0, _ROOT_DIR)
+
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from api.config import CORS_ALLOW_ORIGINS
+from api._shared import close_http_client, get_http_client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时预先创建共享的 HTTP 连接池，关闭时释放。"""
+    get_http_client()
+    yield
+    await close_http_client()
+
+
 # 创建统一的 FastAPI app
-app = FastAPI(title="Translation & Billing API")
+app = FastAPI(title="Translation & Billing API", lifespan=lifespan)
 
-# 配置 CORS
+# 配置 CORS（明确的来源/方法/请求头，不与 credentials 混用通配符）
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ALLOW_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["authorization", "content-type"],
 )
 
 # 导入路由
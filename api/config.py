@@ -1,8 +1,10 @@
 """
-配置模块 - 从 .env 文件或环境变量读取配置
+配置模块 - 从 .env 文件或环境变量读取配置（兼容旧的 config.json）
 """
 
+import json
 import os
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -18,15 +20,48 @@ else:
     # 如果项目根目录没有 .env，也尝试加载当前目录的 .env（兼容性）
     load_dotenv()
 
+
+@lru_cache(maxsize=1)
+def _load_config_json() -> dict:
+    """读取项目根目录的 config.json（旧版本地开发配置），只读一次。"""
+    config_path = root_dir / "config.json"
+    if not config_path.exists():
+        return {}
+    with open(config_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _get(name: str, *legacy_names: str) -> str | None:
+    """优先读取环境变量，缺失时回退到 config.json。"""
+    value = os.getenv(name)
+    if value:
+        return value
+    config = _load_config_json()
+    for key in (name, *legacy_names):
+        if config.get(key):
+            return config[key]
+    return None
+
+
 # Supabase 配置
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+SUPABASE_URL = _get("SUPABASE_URL")
+SUPABASE_SERVICE_KEY = _get("SUPABASE_SERVICE_KEY", "SUPABASE_KEY")
 
 # 智谱 AI 配置
-ZHIPU_API_KEY = os.getenv("ZHIPU_API_KEY")
+ZHIPU_API_KEY = _get("ZHIPU_API_KEY")
+
+# 同时进行中的智谱调用上限（超出的请求排队等待，而不是触发限流）
+ZHIPU_MAX_CONCURRENCY = _get("ZHIPU_MAX_CONCURRENCY") or "10"
 
 # Supabase Anon Key（前端使用，如果需要的话）
-SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
+SUPABASE_ANON_KEY = _get("SUPABASE_ANON_KEY")
+
+# 允许跨域访问的前端来源（逗号分隔）；Vercel 上前后端同源，默认只放行本地 Vite
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in (_get("CORS_ALLOW_ORIGINS") or "http://localhost:3000").split(",")
+    if origin.strip()
+]
 
 # 验证必需的配置
 if not SUPABASE_URL:
@@ -38,3 +73,11 @@ if not SUPABASE_SERVICE_KEY:
 if not ZHIPU_API_KEY:
     raise RuntimeError("缺少 ZHIPU_API_KEY，请在 .env 文件或环境变量中配置")
 
+try:
+    ZHIPU_MAX_CONCURRENCY = int(ZHIPU_MAX_CONCURRENCY)
+except ValueError:
+    raise RuntimeError(f"ZHIPU_MAX_CONCURRENCY 必须是正整数，当前为 {ZHIPU_MAX_CONCURRENCY!r}")
+
+if ZHIPU_MAX_CONCURRENCY < 1:
+    raise RuntimeError(f"ZHIPU_MAX_CONCURRENCY 必须是正整数，当前为 {ZHIPU_MAX_CONCURRENCY}")
+
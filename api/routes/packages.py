@@ -2,15 +2,16 @@
 套餐相关路由
 """
 
-from fastapi import APIRouter
+import hashlib
 
-router = APIRouter()
+import orjson
+from fastapi import APIRouter, Request, Response
 
+router = APIRouter()
 
-@router.get("/packages")
-async def get_packages():
-    """获取套餐列表。"""
-    return [
+# 套餐列表是静态数据，启动时序列化一次
+_PACKAGES_JSON = orjson.dumps(
+    [
         {
             "id": "basic",
             "name": "基础套餐",
@@ -33,4 +34,40 @@ async def get_packages():
             "description": "适合重度使用",
         },
     ]
+)
+
+
+_PACKAGES_ETAG = f'"{hashlib.blake2b(_PACKAGES_JSON, digest_size=16).hexdigest()}"'
 
+# 允许 Vercel 边缘节点缓存，命中时不再调用 Python 函数
+_PACKAGES_HEADERS = {
+    "Cache-Control": "public, max-age=3600, s-maxage=86400, stale-while-revalidate=604800",
+    "ETag": _PACKAGES_ETAG,
+}
+
+
+def _etag_matches(if_none_match: str | None) -> bool:
+    """按 RFC 9110 弱比较判断 If-None-Match 是否命中（忽略 W/ 前缀，支持列表和 *）。"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == _PACKAGES_ETAG:
+            return True
+    return False
+
+
+@router.get("/packages")
+async def get_packages(request: Request):
+    """获取套餐列表。"""
+    if _etag_matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=_PACKAGES_HEADERS)
+    return Response(
+        content=_PACKAGES_JSON,
+        media_type="application/json",
+        headers=_PACKAGES_HEADERS,
+    )
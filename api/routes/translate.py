@@ -2,18 +2,14 @@
 翻译路由
 """
 
-from fastapi import APIRouter, HTTPException, Request
+import anyio
+import orjson
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-try:
-    from api._shared import get_current_user
-    from api.services.translate_service import TranslateService
-except ImportError:
-    import sys
-    import os
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-    from api._shared import get_current_user
-    from api.services.translate_service import TranslateService
+from api._shared import get_current_user, cache_current_user, invalidate_current_user
+from api.services.translate_service import TranslateService
 
 router = APIRouter()
 
@@ -29,8 +25,8 @@ class TranslateResponse(BaseModel):
     remaining_tokens: int
 
 
-@router.post("/translate")
-async def translate(request: Request, body: TranslateRequest):
+@router.post("/translate", response_model=TranslateResponse)
+async def translate(request: Request, body: TranslateRequest, background_tasks: BackgroundTasks):
     """翻译接口 - 调用 service 层处理业务逻辑"""
     authorization = request.headers.get("authorization")
     user = await get_current_user(authorization)
@@ -40,8 +36,11 @@ async def translate(request: Request, body: TranslateRequest):
         translated_text, estimated_tokens, remaining_tokens = await TranslateService.translate_text(
             user=user,
             text=body.text,
-            target_lang=body.target_lang
+            target_lang=body.target_lang,
+            background_tasks=background_tasks,
         )
+        # 用量已变化，刷新用户缓存
+        await cache_current_user(authorization, user)
         
         return TranslateResponse(
             translated_text=translated_text,
@@ -49,9 +48,59 @@ async def translate(request: Request, body: TranslateRequest):
             remaining_tokens=remaining_tokens,
         )
     except ValueError as e:
-        # 业务逻辑错误（如额度不足）
+        # 业务逻辑错误（如额度不足）；缓存的用量可能已过期，丢弃后下次重新读取
+        await invalidate_current_user(authorization)
         raise HTTPException(status_code=402, detail=str(e))
     except RuntimeError as e:
         # 翻译服务错误
         raise HTTPException(status_code=500, detail=str(e))
 
+
+def _sse(data: dict) -> bytes:
+    """编码一条 SSE 事件。"""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+@router.post("/translate/stream")
+async def translate_stream(request: Request, body: TranslateRequest):
+    """
+    流式翻译接口（text/event-stream）
+    
+    依次推送 {"delta": ...} 片段，最后推送 {"done": true, "estimated_tokens", "remaining_tokens"}；
+    翻译中途出错时推送 {"error": ...}。
+    """
+    authorization = request.headers.get("authorization")
+    user = await get_current_user(authorization)
+
+    try:
+        deltas, estimated_tokens, remaining_tokens = await TranslateService.translate_text_stream(
+            user=user,
+            text=body.text,
+            target_lang=body.target_lang,
+        )
+    except ValueError as e:
+        # 业务逻辑错误（如额度不足）；缓存的用量可能已过期，丢弃后下次重新读取
+        await invalidate_current_user(authorization)
+        raise HTTPException(status_code=402, detail=str(e))
+
+    async def events():
+        try:
+            async for delta in deltas:
+                yield _sse({"delta": delta})
+        except Exception as e:
+            yield _sse({"error": f"翻译失败: {e}"})
+            return
+        finally:
+            # 流结束（含出错、客户端断开）后用量才确定：先让 service 完成记账/退还，再刷新用户缓存
+            with anyio.CancelScope(shield=True):
+                await deltas.aclose()
+                await cache_current_user(authorization, user)
+        yield _sse(
+            {
+                "done": True,
+                "estimated_tokens": estimated_tokens,
+                "remaining_tokens": remaining_tokens,
+            }
+        )
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -3,21 +3,22 @@
 """
 
 from fastapi import APIRouter, Request
+from pydantic import BaseModel
 
-try:
-    from api._shared import get_current_user
-    from api.services.user_service import UserService
-except ImportError:
-    import sys
-    import os
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-    from api._shared import get_current_user
-    from api.services.user_service import UserService
+from api._shared import get_current_user
+from api.services.user_service import UserService
 
 router = APIRouter()
 
 
-@router.get("/me/usage")
+class UsageResponse(BaseModel):
+    monthly_quota_tokens: int
+    used_tokens_this_period: int
+    billing_period_start: str
+    remaining_tokens: int
+
+
+@router.get("/me/usage", response_model=UsageResponse)
 async def get_usage(request: Request):
     """供前端展示当前配额和已用量 - 调用 service 层"""
     authorization = request.headers.get("authorization")
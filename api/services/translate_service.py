@@ -2,109 +2,174 @@
 翻译服务 - 处理翻译相关的业务逻辑
 """
 
-import datetime as dt
-from typing import Tuple
-
-try:
-    from api._shared import (
-        get_supabase_client,
-        translate_text_sync,
-        estimate_tokens,
-        refresh_billing_period,
-        AuthedUser,
-    )
-except ImportError:
-    import sys
-    import os
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-    from api._shared import (
-        get_supabase_client,
-        translate_text_sync,
-        estimate_tokens,
-        refresh_billing_period,
-        AuthedUser,
-    )
+import asyncio
+import base64
+import threading
+from typing import AsyncIterator, Optional, Tuple
+
+import anyio
+import zstandard as zstd
+from fastapi import BackgroundTasks
+from supabase import Client
+
+from api._shared import (
+    get_supabase_client,
+    translate_text_async,
+    translate_text_stream,
+    estimate_tokens,
+    AuthedUser,
+)
+
+
+# zstd 压缩器不能被多个线程同时使用，每个线程各持一个
+_ZSTD_LOCAL = threading.local()
+
+
+def _compress_text(text: str) -> str:
+    """zstd（level 3）压缩文本，返回 base64 字符串以便经 PostgREST 以 JSON 传输。"""
+    compressor = getattr(_ZSTD_LOCAL, "compressor", None)
+    if compressor is None:
+        compressor = _ZSTD_LOCAL.compressor = zstd.ZstdCompressor(level=3)
+    return base64.b64encode(compressor.compress(text.encode("utf-8"))).decode("ascii")
 
 
 class TranslateService:
     """翻译服务类"""
     
+    @staticmethod
+    async def _reserve_tokens(sb: Client, user: AuthedUser, est_tokens: int) -> dict:
+        """
+        在数据库中原子预占额度，并发请求不会一起越过额度检查
+        
+        Returns:
+            {"used_tokens_this_period", "monthly_quota_tokens", "remaining_tokens"}
+        """
+        remaining = user.monthly_quota_tokens - user.used_tokens_this_period
+
+        if est_tokens > remaining:
+            raise ValueError(f"本月额度不足，剩余 {remaining} tokens，需要 {est_tokens} tokens")
+
+        # supabase 同步客户端会阻塞，放到线程中执行，不占用事件循环
+        reserve = sb.rpc(
+            "try_reserve_tokens",
+            {"p_user_id": user.user_row_id, "p_estimated": est_tokens},
+        )
+        usage = (await asyncio.to_thread(reserve.execute)).data
+        if usage is None:
+            # 本地用量可能已过期，不在提示里给出剩余额度
+            raise ValueError(f"本月额度不足，需要 {est_tokens} tokens")
+
+        user.used_tokens_this_period = usage["used_tokens_this_period"]
+        user.monthly_quota_tokens = usage["monthly_quota_tokens"]
+        return usage
+
+    @staticmethod
+    async def _release_tokens(sb: Client, user: AuthedUser, est_tokens: int) -> None:
+        """翻译失败时退还预占的额度"""
+        release = sb.rpc(
+            "release_tokens",
+            {"p_user_id": user.user_row_id, "p_tokens": est_tokens},
+        )
+        await asyncio.to_thread(release.execute)
+
+    @staticmethod
+    def _record_translation(sb: Client, user: AuthedUser, text: str, result: str, est_tokens: int) -> None:
+        """
+        记录 usage_logs 并更新按月汇总（单次 RPC，数据库内同一事务）
+        
+        原文与译文经 zstd 压缩后写入；同步执行，由调用方放到线程池或后台任务中。
+        """
+        start = user.billing_period_start
+        period_start_iso = f"{start.year:04d}-{start.month:02d}-01"
+        sb.rpc(
+            "record_translation",
+            {
+                "p_user_id": user.user_row_id,
+                "p_tokens": est_tokens,
+                "p_input_chars": len(text),
+                "p_original_zstd": _compress_text(text),
+                "p_translated_zstd": _compress_text(result),
+                "p_period_start": period_start_iso,
+                "p_model": "glm-4.5",
+            },
+        ).execute()
+
     @staticmethod
     async def translate_text(
         user: AuthedUser,
         text: str,
-        target_lang: str = "英文"
+        target_lang: str = "英文",
+        background_tasks: Optional[BackgroundTasks] = None,
     ) -> Tuple[str, int, int]:
         """
         执行翻译并更新用量
         
+        传入 background_tasks 时，使用日志在响应返回后再写入。
+        
         Returns:
             (translated_text, estimated_tokens, remaining_tokens)
         """
         sb = get_supabase_client()
-        user = refresh_billing_period(sb, user)
 
         est_tokens = estimate_tokens(text)
-        remaining = user.monthly_quota_tokens - user.used_tokens_this_period
-
-        if est_tokens > remaining:
-            raise ValueError(f"本月额度不足，剩余 {remaining} tokens，需要 {est_tokens} tokens")
+        usage = await TranslateService._reserve_tokens(sb, user, est_tokens)
 
-        # 调用智谱翻译
-        ok, result, _elapsed = translate_text_sync(text, target_lang)
+        # 调用智谱翻译，失败则退还预占的额度
+        ok, result, _elapsed = await translate_text_async(text, target_lang)
         if not ok:
+            await TranslateService._release_tokens(sb, user, est_tokens)
+            user.used_tokens_this_period -= est_tokens
             raise RuntimeError(f"翻译失败: {result}")
 
-        # 记录 usage_logs & 更新 users 表的用量
-        new_used = user.used_tokens_this_period + est_tokens
+        # 仅用于审计/统计，额度已预占；有 background_tasks 时放到响应返回之后执行
+        record_args = (sb, user, text, result, est_tokens)
+        if background_tasks is not None:
+            background_tasks.add_task(TranslateService._record_translation, *record_args)
+        else:
+            await asyncio.to_thread(TranslateService._record_translation, *record_args)
 
-        # 记录使用日志
-        sb.table("usage_logs").insert(
-            {
-                "user_id": user.user_row_id,
-                "model": "glm-4.5",
-                "input_chars": len(text),
-                "estimated_tokens": est_tokens,
-                "cost_in_cents": 0,
-                "original_text": text,
-                "translated_text": result,
-            }
-        ).execute()
+        return result, est_tokens, usage["remaining_tokens"]
 
-        # 更新按月汇总表 user_monthly_usage
-        period_start = dt.date(user.billing_period_start.year, user.billing_period_start.month, 1)
-        existing = (
-            sb.table("user_monthly_usage")
-            .select("*")
-            .eq("user_id", user.user_row_id)
-            .eq("period_start", period_start.isoformat())
-            .execute()
-        ).data
-
-        if existing:
-            row = existing[0]
-            sb.table("user_monthly_usage").update(
-                {
-                    "total_tokens": row.get("total_tokens", 0) + est_tokens,
-                    "total_requests": row.get("total_requests", 0) + 1,
-                    "updated_at": dt.datetime.utcnow().isoformat(),
-                }
-            ).eq("id", row["id"]).execute()
-        else:
-            sb.table("user_monthly_usage").insert(
-                {
-                    "user_id": user.user_row_id,
-                    "period_start": period_start.isoformat(),
-                    "total_tokens": est_tokens,
-                    "total_requests": 1,
-                }
-            ).execute()
-
-        # 更新用户用量
-        sb.table("users").update(
-            {"used_tokens_this_period": new_used}
-        ).eq("id", user.user_row_id).execute()
-
-        remaining_tokens = user.monthly_quota_tokens - new_used
-        return result, est_tokens, remaining_tokens
+    @staticmethod
+    async def translate_text_stream(
+        user: AuthedUser,
+        text: str,
+        target_lang: str = "英文",
+    ) -> Tuple[AsyncIterator[str], int, int]:
+        """
+        流式翻译：先预占额度（额度不足时直接抛出 ValueError），再逐段产出译文
+        
+        流结束后记账：上游正常结束，或客户端在收到内容后断开时写入使用日志；
+        上游出错或未产出任何内容时退还额度（同时回退 user 上的用量）。
+        
+        Returns:
+            (译文片段的异步迭代器, estimated_tokens, remaining_tokens)
+        """
+        sb = get_supabase_client()
+
+        est_tokens = estimate_tokens(text)
+        usage = await TranslateService._reserve_tokens(sb, user, est_tokens)
+
+        async def deltas() -> AsyncIterator[str]:
+            parts = []
+            upstream_failed = False
+            try:
+                try:
+                    async for delta in translate_text_stream(text, target_lang):
+                        parts.append(delta)
+                        yield delta
+                except Exception:
+                    upstream_failed = True
+                    raise
+            finally:
+                # 客户端断开时请求已被取消，记账需屏蔽取消以保证执行
+                with anyio.CancelScope(shield=True):
+                    if parts and not upstream_failed:
+                        await asyncio.to_thread(
+                            TranslateService._record_translation, sb, user, text, "".join(parts), est_tokens
+                        )
+                    else:
+                        await TranslateService._release_tokens(sb, user, est_tokens)
+                        user.used_tokens_this_period -= est_tokens
 
+        return deltas(), est_tokens, usage["remaining_tokens"]
@@ -2,13 +2,7 @@
 用户服务 - 处理用户相关的业务逻辑
 """
 
-try:
-    from api._shared import AuthedUser
-except ImportError:
-    import sys
-    import os
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-    from api._shared import AuthedUser
+from api._shared import AuthedUser
 
 
 class UserService:
@@ -0,0 +1,64 @@
+-- 翻译完成后的记账：一次 RPC 内完成 usage_logs 写入、按月汇总和用户用量累加
+
+-- 建唯一索引前先合并历史重复行：同一用户同一周期的 total_tokens / total_requests 累加到一行，其余删除
+with dup as (
+    select user_id, period_start,
+           min(ctid) as keep_ctid,
+           sum(total_tokens) as total_tokens,
+           sum(total_requests) as total_requests
+    from public.user_monthly_usage
+    group by user_id, period_start
+    having count(*) > 1
+),
+merged as (
+    update public.user_monthly_usage m
+    set total_tokens = dup.total_tokens,
+        total_requests = dup.total_requests
+    from dup
+    where m.ctid = dup.keep_ctid
+    returning m.user_id
+)
+delete from public.user_monthly_usage m
+using dup
+where m.user_id = dup.user_id
+  and m.period_start = dup.period_start
+  and m.ctid <> dup.keep_ctid;
+
+create unique index if not exists user_monthly_usage_user_id_period_start_key
+    on public.user_monthly_usage (user_id, period_start);
+
+create or replace function public.record_translation(
+    p_user_id bigint,
+    p_tokens integer,
+    p_input_chars integer,
+    p_original text,
+    p_translated text,
+    p_period_start date,
+    p_model text default 'glm-4.5'
+)
+returns integer
+language plpgsql
+as $$
+declare
+    v_used integer;
+begin
+    insert into public.usage_logs
+        (user_id, model, input_chars, estimated_tokens, cost_in_cents, original_text, translated_text)
+    values
+        (p_user_id, p_model, p_input_chars, p_tokens, 0, p_original, p_translated);
+
+    insert into public.user_monthly_usage (user_id, period_start, total_tokens, total_requests)
+    values (p_user_id, p_period_start, p_tokens, 1)
+    on conflict (user_id, period_start) do update
+        set total_tokens = public.user_monthly_usage.total_tokens + excluded.total_tokens,
+            total_requests = public.user_monthly_usage.total_requests + 1,
+            updated_at = now();
+
+    update public.users
+       set used_tokens_this_period = used_tokens_this_period + p_tokens
+     where id = p_user_id
+    returning used_tokens_this_period into v_used;
+
+    return v_used;
+end;
+$$;
@@ -0,0 +1,48 @@
+-- 按月汇总的原子累加：INSERT ... ON CONFLICT 取代先 SELECT 再 UPDATE/INSERT
+
+create or replace function public.increment_monthly_usage(
+    p_user_id bigint,
+    p_period_start date,
+    p_tokens integer
+)
+returns void
+language sql
+as $$
+    insert into public.user_monthly_usage (user_id, period_start, total_tokens, total_requests)
+    values (p_user_id, p_period_start, p_tokens, 1)
+    on conflict (user_id, period_start) do update
+        set total_tokens = public.user_monthly_usage.total_tokens + excluded.total_tokens,
+            total_requests = public.user_monthly_usage.total_requests + 1,
+            updated_at = now();
+$$;
+
+create or replace function public.record_translation(
+    p_user_id bigint,
+    p_tokens integer,
+    p_input_chars integer,
+    p_original text,
+    p_translated text,
+    p_period_start date,
+    p_model text default 'glm-4.5'
+)
+returns integer
+language plpgsql
+as $$
+declare
+    v_used integer;
+begin
+    insert into public.usage_logs
+        (user_id, model, input_chars, estimated_tokens, cost_in_cents, original_text, translated_text)
+    values
+        (p_user_id, p_model, p_input_chars, p_tokens, 0, p_original, p_translated);
+
+    perform public.increment_monthly_usage(p_user_id, p_period_start, p_tokens);
+
+    update public.users
+       set used_tokens_this_period = used_tokens_this_period + p_tokens
+     where id = p_user_id
+    returning used_tokens_this_period into v_used;
+
+    return v_used;
+end;
+$$;
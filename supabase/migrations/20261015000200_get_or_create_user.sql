@@ -0,0 +1,48 @@
+-- 认证用户映射到 public.users：一次调用完成“查找或创建”，只返回后端用到的列
+
+-- 重复的 auth_user_id 关联着各自的 usage_logs / user_monthly_usage，无法安全地自动合并，
+-- 存在重复时直接中止迁移。可先用下面的查询排查并手工合并：
+--   select auth_user_id, array_agg(id order by id) as ids
+--   from public.users
+--   where auth_user_id is not null
+--   group by auth_user_id
+--   having count(*) > 1;
+do $$
+begin
+    if exists (
+        select 1
+        from public.users
+        where auth_user_id is not null
+        group by auth_user_id
+        having count(*) > 1
+    ) then
+        raise exception 'public.users 存在重复的 auth_user_id，请先合并后再执行本迁移';
+    end if;
+end
+$$;
+
+create unique index if not exists users_auth_user_id_key
+    on public.users (auth_user_id);
+
+create or replace function public.get_or_create_user(
+    p_auth_user_id uuid,
+    p_name text
+)
+returns table (
+    id bigint,
+    monthly_quota_tokens bigint,
+    used_tokens_this_period bigint,
+    billing_period_start date
+)
+language sql
+as $$
+    insert into public.users as u (auth_user_id, name)
+    values (p_auth_user_id, p_name)
+    -- 空更新让冲突时也能 RETURNING 已存在的行，且不覆盖已有的 name
+    on conflict (auth_user_id) do update set auth_user_id = excluded.auth_user_id
+    returning
+        u.id::bigint,
+        u.monthly_quota_tokens::bigint,
+        u.used_tokens_this_period::bigint,
+        u.billing_period_start::date;
+$$;
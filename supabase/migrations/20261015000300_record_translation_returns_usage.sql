@@ -0,0 +1,39 @@
+-- record_translation 直接返回最新用量与剩余额度，后端不再自行推算
+
+drop function if exists public.record_translation(bigint, integer, integer, text, text, date, text);
+
+create function public.record_translation(
+    p_user_id bigint,
+    p_tokens integer,
+    p_input_chars integer,
+    p_original text,
+    p_translated text,
+    p_period_start date,
+    p_model text default 'glm-4.5'
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_used bigint;
+    v_quota bigint;
+begin
+    insert into public.usage_logs
+        (user_id, model, input_chars, estimated_tokens, cost_in_cents, original_text, translated_text)
+    values
+        (p_user_id, p_model, p_input_chars, p_tokens, 0, p_original, p_translated);
+
+    perform public.increment_monthly_usage(p_user_id, p_period_start, p_tokens);
+
+    update public.users
+       set used_tokens_this_period = used_tokens_this_period + p_tokens
+     where id = p_user_id
+    returning used_tokens_this_period, monthly_quota_tokens into v_used, v_quota;
+
+    return jsonb_build_object(
+        'used_tokens_this_period', v_used,
+        'monthly_quota_tokens', v_quota,
+        'remaining_tokens', v_quota - v_used
+    );
+end;
+$$;
@@ -0,0 +1,61 @@
+-- 用户用量的原子累加（含跨月重置），取代后端的“读-改-写”
+
+create or replace function public.increment_user_usage(
+    p_user_id bigint,
+    p_tokens integer
+)
+returns table (
+    used_tokens_this_period bigint,
+    monthly_quota_tokens bigint
+)
+language sql
+as $$
+    update public.users as u
+       set used_tokens_this_period = case
+               when date_trunc('month', u.billing_period_start) = date_trunc('month', current_date)
+               then u.used_tokens_this_period + p_tokens
+               else p_tokens
+           end,
+           billing_period_start = case
+               when date_trunc('month', u.billing_period_start) = date_trunc('month', current_date)
+               then u.billing_period_start
+               else current_date
+           end
+     where u.id = p_user_id
+    returning u.used_tokens_this_period::bigint, u.monthly_quota_tokens::bigint;
+$$;
+
+create or replace function public.record_translation(
+    p_user_id bigint,
+    p_tokens integer,
+    p_input_chars integer,
+    p_original text,
+    p_translated text,
+    p_period_start date,
+    p_model text default 'glm-4.5'
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_used bigint;
+    v_quota bigint;
+begin
+    insert into public.usage_logs
+        (user_id, model, input_chars, estimated_tokens, cost_in_cents, original_text, translated_text)
+    values
+        (p_user_id, p_model, p_input_chars, p_tokens, 0, p_original, p_translated);
+
+    perform public.increment_monthly_usage(p_user_id, p_period_start, p_tokens);
+
+    select used_tokens_this_period, monthly_quota_tokens
+      into v_used, v_quota
+      from public.increment_user_usage(p_user_id, p_tokens);
+
+    return jsonb_build_object(
+        'used_tokens_this_period', v_used,
+        'monthly_quota_tokens', v_quota,
+        'remaining_tokens', v_quota - v_used
+    );
+end;
+$$;
@@ -0,0 +1,82 @@
+-- 调用模型前原子预占额度：并发请求无法同时越过额度检查，额度不足时不再浪费模型调用
+
+create or replace function public.try_reserve_tokens(
+    p_user_id bigint,
+    p_estimated integer
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_used bigint;
+    v_quota bigint;
+begin
+    update public.users as u
+       set used_tokens_this_period = case
+               when date_trunc('month', u.billing_period_start) = date_trunc('month', current_date)
+               then u.used_tokens_this_period + p_estimated
+               else p_estimated
+           end,
+           billing_period_start = case
+               when date_trunc('month', u.billing_period_start) = date_trunc('month', current_date)
+               then u.billing_period_start
+               else current_date
+           end
+     where u.id = p_user_id
+       and case
+               when date_trunc('month', u.billing_period_start) = date_trunc('month', current_date)
+               then u.used_tokens_this_period + p_estimated
+               else p_estimated
+           end <= u.monthly_quota_tokens
+    returning u.used_tokens_this_period, u.monthly_quota_tokens into v_used, v_quota;
+
+    if not found then
+        return null;
+    end if;
+
+    return jsonb_build_object(
+        'used_tokens_this_period', v_used,
+        'monthly_quota_tokens', v_quota,
+        'remaining_tokens', v_quota - v_used
+    );
+end;
+$$;
+
+-- 模型调用失败时退还预占的额度
+create or replace function public.release_tokens(
+    p_user_id bigint,
+    p_tokens integer
+)
+returns void
+language sql
+as $$
+    update public.users
+       set used_tokens_this_period = greatest(used_tokens_this_period - p_tokens, 0)
+     where id = p_user_id;
+$$;
+
+-- 用量已在预占时扣除，record_translation 只负责日志和按月汇总
+drop function if exists public.record_translation(bigint, integer, integer, text, text, date, text);
+drop function if exists public.increment_user_usage(bigint, integer);
+
+create function public.record_translation(
+    p_user_id bigint,
+    p_tokens integer,
+    p_input_chars integer,
+    p_original text,
+    p_translated text,
+    p_period_start date,
+    p_model text default 'glm-4.5'
+)
+returns void
+language plpgsql
+as $$
+begin
+    insert into public.usage_logs
+        (user_id, model, input_chars, estimated_tokens, cost_in_cents, original_text, translated_text)
+    values
+        (p_user_id, p_model, p_input_chars, p_tokens, 0, p_original, p_translated);
+
+    perform public.increment_monthly_usage(p_user_id, p_period_start, p_tokens);
+end;
+$$;
@@ -0,0 +1,35 @@
+-- usage_logs 的原文/译文改为 zstd 压缩后存储，减小写入请求体积与存储占用
+-- 旧数据仍保留在 original_text / translated_text 中；新记录只写压缩列
+
+alter table public.usage_logs
+    add column if not exists original_text_zstd bytea,
+    add column if not exists translated_text_zstd bytea,
+    alter column original_text drop not null,
+    alter column translated_text drop not null;
+
+drop function if exists public.record_translation(bigint, integer, integer, text, text, date, text);
+
+-- p_original_zstd / p_translated_zstd：zstd 压缩后再 base64 编码的文本
+create function public.record_translation(
+    p_user_id bigint,
+    p_tokens integer,
+    p_input_chars integer,
+    p_original_zstd text,
+    p_translated_zstd text,
+    p_period_start date,
+    p_model text default 'glm-4.5'
+)
+returns void
+language plpgsql
+as $$
+begin
+    insert into public.usage_logs
+        (user_id, model, input_chars, estimated_tokens, cost_in_cents,
+         original_text_zstd, translated_text_zstd)
+    values
+        (p_user_id, p_model, p_input_chars, p_tokens, 0,
+         decode(p_original_zstd, 'base64'), decode(p_translated_zstd, 'base64'));
+
+    perform public.increment_monthly_usage(p_user_id, p_period_start, p_tokens);
+end;
+$$;
@@ -0,0 +1,19 @@
+-- 以下函数只供后端（service_role）调用：默认权限下持有 anon key 的任何人都能经 /rest/v1/rpc 调用，
+-- 例如直接调用 release_tokens 给自己退还额度
+
+revoke execute on function public.get_or_create_user(uuid, text) from public, anon, authenticated;
+grant execute on function public.get_or_create_user(uuid, text) to service_role;
+
+revoke execute on function public.try_reserve_tokens(bigint, integer) from public, anon, authenticated;
+grant execute on function public.try_reserve_tokens(bigint, integer) to service_role;
+
+revoke execute on function public.release_tokens(bigint, integer) from public, anon, authenticated;
+grant execute on function public.release_tokens(bigint, integer) to service_role;
+
+revoke execute on function public.increment_monthly_usage(bigint, date, integer) from public, anon, authenticated;
+grant execute on function public.increment_monthly_usage(bigint, date, integer) to service_role;
+
+revoke execute on function public.record_translation(bigint, integer, integer, text, text, date, text)
+    from public, anon, authenticated;
+grant execute on function public.record_translation(bigint, integer, integer, text, text, date, text)
+    to service_role;